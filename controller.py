@@ -101,7 +101,7 @@ class DragEnd(CursorState):
         return Hover(Point(event.x, event.y))
 
     def button_release(self, event):
-        if rel.dist() > self.drag_threshold:
+        if self.rel.magnitude() > self.drag_threshold:
             return DragEnd(Point(event.x, event.y), self.origin)
         else:
             return Click(Point(event.x, event.y))
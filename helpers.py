@@ -22,11 +22,38 @@ import gi
 gi.require_version("Gtk", "3.0")
 gi.require_version("Pango", "1.0")
 gi.require_foreign("cairo")
-from gi.repository import Pango
-from gi.repository import PangoCairo
-import cmath
+from collections import OrderedDict
+from dataclasses import dataclass, field
 import math
-import traceback
+
+
+# PangoCairo is only needed for text, so the typelib is loaded on first
+# use rather than at import time.
+_PangoCairo = None
+
+# All the layouts created by helpers share one Pango context, which is
+# updated to match the cairo context each time a layout is created.
+_pango_context = None
+
+
+def _pangocairo():
+    global _PangoCairo
+    if _PangoCairo is None:
+        gi.require_version("PangoCairo", "1.0")
+        from gi.repository import PangoCairo
+        _PangoCairo = PangoCairo
+    return _PangoCairo
+
+
+def _new_layout(cr):
+    global _pango_context
+    PangoCairo = _pangocairo()
+    if _pango_context is None:
+        _pango_context = PangoCairo.create_context(cr)
+    else:
+        PangoCairo.update_context(cr, _pango_context)
+    from gi.repository import Pango
+    return Pango.Layout.new(_pango_context)
 
 
 class Helper(object):
@@ -40,7 +67,7 @@ class Helper(object):
     - center rect
     - center round rect
     - center text
-    - polygon
+    - polygon, polyline_xy
     - vertical and horizontal lines
 
     Transform Context Managers (so you cannot forget `restore()`):
@@ -57,12 +84,17 @@ class Helper(object):
     - debug_fill()   - fill the path using CAIRO_INVERSE
     """
 
+    # Layouts created by show_text(), shared between instances and keyed
+    # on (text, font), so that repeated labels are only laid out once.
+    layout_cache_size = 256
+    _layouts = OrderedDict()
+
     def __init__(self, cr):
         self.cr = cr
 
     def circle(self, center, radius):
         self.cr.new_sub_path()
-        self.cr.arc(center.x, center.y, radius, 0, 2 * math.pi)
+        self.cr.arc(center.x, center.y, radius, 0, math.tau)
 
     def elipse(self, center, width, height):
         with self.save():
@@ -72,11 +104,26 @@ class Helper(object):
             self.circle(Point(0, 0), width)
 
     def get_layout(self, text, font):
-        layout = PangoCairo.create_layout(self.cr)
+        layout = _new_layout(self.cr)
         layout.set_font_description(font)
         layout.set_text(text, -1)
         return layout
 
+    def _get_cached_layout(self, text, font):
+        key = (text, font.to_string())
+        layouts = self._layouts
+        layout = layouts.get(key)
+        if layout is None:
+            layout = self.get_layout(text, font)
+            layouts[key] = layout
+            if len(layouts) > self.layout_cache_size:
+                layouts.popitem(last=False)
+        else:
+            layouts.move_to_end(key)
+            # the layout may have been created against another context.
+            _pangocairo().update_layout(self.cr, layout)
+        return layout
+
     def get_layout_rect(self, layout, centered=True):
         rect = layout.get_pixel_extents()[0]
         return Rect(
@@ -99,10 +146,10 @@ class Helper(object):
                 x, y = self.cr.get_current_point()
                 self.cr.translate(x - tw * 0.5 - rect.x, y - th * 0.5 - rect.y)
                 self.cr.move_to(0, 0)
-        PangoCairo.show_layout(self.cr, layout)
+        _pangocairo().show_layout(self.cr, layout)
 
     def show_text(self, text, font, centered=True):
-        self.show_layout(self.get_layout(text,font), centered)
+        self.show_layout(self._get_cached_layout(text, font), centered)
 
     # this is now deprecated
     def center_text(self, text, font):
@@ -115,16 +162,18 @@ class Helper(object):
         raise NotImplementedError()
 
     def rect(self, rect):
-        self.center_rect(rect.center, rect.width, rect.height)
+        center = rect.center
+        self.cr.rectangle(
+            center.x - rect._hw, center.y - rect._hh, rect.width, rect.height)
 
     def round_rect(self, rect):
         self.round_rect(rect.center, rect.width, rect.height)
 
     def move_to(self, point):
-        self.cr.move_to(*point)
+        self.cr.move_to(point.x, point.y)
 
     def line_to(self, point):
-        self.cr.line_to(*point)
+        self.cr.line_to(point.x, point.y)
 
     def arc(self, center, rad, start, end):
         self.cr.arc(center.x, center.y, rad, start, end)
@@ -140,12 +189,51 @@ class Helper(object):
         self.cr.move_to(pos, rect.north().y)
         self.cr.line_to(pos, rect.south().y)
 
+    def hlines(self, positions, rect):
+        """Add a horizontal line across `rect` at each of `positions`."""
+        move_to = self.cr.move_to
+        line_to = self.cr.line_to
+        east = rect.center.x + rect._hw
+        west = rect.center.x - rect._hw
+        for pos in positions:
+            move_to(east, pos)
+            line_to(west, pos)
+
+    def vlines(self, positions, rect):
+        """Add a vertical line across `rect` at each of `positions`."""
+        move_to = self.cr.move_to
+        line_to = self.cr.line_to
+        north = rect.center.y - rect._hh
+        south = rect.center.y + rect._hh
+        for pos in positions:
+            move_to(pos, north)
+            line_to(pos, south)
+
     def polygon(self, *points, close=True):
-        self.move_to(points[0])
+        # pycairo cannot build a cairo.Path from Python, so the best we
+        # can do is keep the per-vertex work down to one bound call with
+        # raw coordinates.
+        line_to = self.cr.line_to
+        first = points[0]
+        self.cr.move_to(first.x, first.y)
         for point in points[1:]:
-            self.line_to(point)
+            line_to(point.x, point.y)
+        if close:
+            self.cr.close_path()
+
+    def polyline_xy(self, xs, ys, close=True):
+        """Like polygon, but with the coordinates in two flat sequences.
+
+        `xs` and `ys` hold the x and y coordinates of each vertex, for
+        example as `array.array('d')`. For large vertex counts this
+        avoids allocating a Point per vertex.
+        """
+        line_to = self.cr.line_to
+        self.cr.move_to(xs[0], ys[0])
+        for x, y in zip(xs[1:], ys[1:]):
+            line_to(x, y)
         if close:
-            self.cr.close()
+            self.cr.close_path()
 
     def curve(self, close=False, *points):
         raise NotImplementedError()
@@ -178,105 +266,183 @@ class Point(object):
 
     """Reasonably terse 2D Point class."""
 
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y): self.x = float(x) ; self.y = float(y)
     def __eq__(self, o):
-        return isinstance(o, Point) and (self.x, self.y) == (o.x, o.y)
+        return o.__class__ is Point and self.x == o.x and self.y == o.y
     def __repr__(self):       return "(%g,%g)" % (self.x, self.y)
     def __iter__(self):       yield  self.x ; yield self.y
     def __hash__(self):       return hash((self.x, self.y))
-    def __bool__(self):       return False
 
-    def len(self): return math.sqrt(self.x ** 2 + self.y ** 2)
+    def magnitude(self): return math.hypot(self.x, self.y)
+    def magnitude_sq(self): return self.x * self.x + self.y * self.y
+
+    def __add__(self, o):
+        if o.__class__ is Point: return Point(self.x + o.x, self.y + o.y)
+        return Point(self.x + o, self.y + o)
+
+    def __sub__(self, o):
+        if o.__class__ is Point: return Point(self.x - o.x, self.y - o.y)
+        return Point(self.x - o, self.y - o)
 
-    def binop(func):
-        def impl(self, x):
-            o = x if isinstance(x, Point) else Point(x, x)
-            return Point(func(self.x, o.x), func(self.y, o.y))
-        return impl
+    def __mul__(self, o):
+        if o.__class__ is Point: return Point(self.x * o.x, self.y * o.y)
+        return Point(self.x * o, self.y * o)
 
-    __add__  = binop(lambda a, b: a + b)
-    __sub__  = binop(lambda a, b: a - b)
-    __mul__  = binop(lambda a, b: a * b)
-    __rsub__ = binop(lambda a, b: b - a)
-    __rmul__ = binop(lambda a, b: b * a)
-    __truediv__  = binop(lambda a, b: a / b)
-    __rtruediv__ = binop(lambda a, b: b / a)
+    def __truediv__(self, o):
+        if o.__class__ is Point: return Point(self.x / o.x, self.y / o.y)
+        return Point(self.x / o, self.y / o)
+
+    # The reflected operators are only reached when the left operand is
+    # not a Point, so they only need to handle scalars.
+    def __rsub__(self, o):     return Point(o - self.x, o - self.y)
+    def __rmul__(self, o):     return Point(o * self.x, o * self.y)
+    def __rtruediv__(self, o): return Point(o / self.x, o / self.y)
 
     @classmethod
     def from_polar(cls, r, theta):
-        rect = cmath.rect(r, theta)
-        return Point(rect.real, rect.imag)
+        return Point(r * math.cos(theta), r * math.sin(theta))
+
 
+@dataclass(frozen=True, slots=True)
+class Rect:
 
-class Rect(object):
+    """Rectangle operations for layout.
 
-    """Rectangle operations for layout."""
+    Rects are immutable, which allows derived geometry to be cached.
+    """
 
-    def __init__(self, center, width, height):
-        self.center = center
-        self.width = width
-        self.height = height
+    center: Point
+    width: float
+    height: float
+    _hw: float = field(init=False, repr=False, compare=False)
+    _hh: float = field(init=False, repr=False, compare=False)
+    _radius: float = field(init=False, repr=False, compare=False)
+    _points: tuple = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # Rects are frozen, so derived values must bypass __setattr__.
+        hw = 0.5 * self.width
+        hh = 0.5 * self.height
+        object.__setattr__(self, '_hw', hw)
+        object.__setattr__(self, '_hh', hh)
+        object.__setattr__(self, '_radius', hw if hw < hh else hh)
+        object.__setattr__(self, '_points', None)
 
     @classmethod
-    def from_top_left(self, top_left, width, height):
-        return Rect(
-            Point(top_left.x + width * 0.5, top_left.y + height * 0.5),
-            width, height
-        )
+    def from_top_left(cls, top_left, width, height):
+        return cls._from_corner_xy(top_left.x, top_left.y, width, height)
+
+    @classmethod
+    def _from_corner_xy(cls, left, top, width, height):
+        """Create a Rect from raw top-left coordinates."""
+        return cls(
+            Point(left + width * 0.5, top + height * 0.5), width, height)
+
+    @classmethod
+    def _from_coords(cls, cx, cy, width, height):
+        """Create a Rect from raw center coordinates."""
+        return cls(Point(cx, cy), width, height)
 
     def __repr__(self):
         return "(%s, %g, %g)" % (self.center, self.width, self.height)
 
+    def _corners(self):
+        """Return the edge and corner points, computed on first use.
+
+        Order: north, south, east, west, northwest, northeast,
+        southeast, southwest.
+        """
+        points = self._points
+        if points is None:
+            cx = self.center.x
+            cy = self.center.y
+            hw = self._hw
+            hh = self._hh
+            points = (
+                Point(cx, cy - hh),
+                Point(cx, cy + hh),
+                Point(cx + hw, cy),
+                Point(cx - hw, cy),
+                Point(cx - hw, cy - hh),
+                Point(cx + hw, cy - hh),
+                Point(cx + hw, cy + hh),
+                Point(cx - hw, cy + hh),
+            )
+            object.__setattr__(self, '_points', points)
+        return points
+
     def north(self):
-        return self.center + Point(0, -0.5 * self.height)
+        return self._corners()[0]
 
     def south(self):
-        return self.center + Point(0, 0.5 * self.height)
+        return self._corners()[1]
 
     def east(self):
-        return self.center + Point(0.5 * self.width, 0)
+        return self._corners()[2]
 
     def west(self):
-        return self.center + Point(-0.5 * self.width, 0)
+        return self._corners()[3]
 
     def northwest(self):
-        return self.center + Point(-0.5 * self.width, -0.5 * self.height)
+        return self._corners()[4]
 
     def northeast(self):
-        return self.center + Point(0.5 * self.width, -0.5 * self.height)
+        return self._corners()[5]
 
     def southeast(self):
-        return self.center + Point(0.5 * self.width, 0.5 * self.height)
+        return self._corners()[6]
 
     def southwest(self):
-        return self.center + Point(-0.5 * self.width, 0.5 * self.height)
+        return self._corners()[7]
 
     def inset(self, size):
         amount = size * 2
         return Rect(self.center, self.width - amount, self.height - amount)
 
     def split_left(self, pos):
-        return self.from_top_left(self.northwest(), pos, self.height)
+        return self._from_coords(
+            self.center.x - self._hw + 0.5 * pos, self.center.y,
+            pos, self.height)
 
     def split_right(self, pos):
-        tl = self.northwest() + Point(pos, 0)
-        return self.from_top_left(tl, self.width - pos, self.height)
+        return self._from_coords(
+            self.center.x + 0.5 * pos, self.center.y,
+            self.width - pos, self.height)
 
     def split_top(self, pos):
-        return self.from_top_left(self.northwest(), self.width, pos)
+        return self._from_coords(
+            self.center.x, self.center.y - self._hh + 0.5 * pos,
+            self.width, pos)
 
     def split_bottom(self, pos):
-        tl = self.northwest() + Point(0, pos)
-        return self.from_top_left(tl, self.width, self.height - pos)
+        return self._from_coords(
+            self.center.x, self.center.y + 0.5 * pos,
+            self.width, self.height - pos)
 
     def split_vertical(self, pos):
-        return (self.split_left(pos), self.split_right(pos))
+        cx = self.center.x
+        cy = self.center.y
+        left = cx - self._hw
+        return (
+            self._from_coords(left + 0.5 * pos, cy, pos, self.height),
+            self._from_coords(
+                cx + 0.5 * pos, cy, self.width - pos, self.height)
+        )
 
     def split_horizontal(self, pos):
-        return (self.split_top(pos), self.split_bottom(pos))
+        cx = self.center.x
+        cy = self.center.y
+        top = cy - self._hh
+        return (
+            self._from_coords(cx, top + 0.5 * pos, self.width, pos),
+            self._from_coords(
+                cx, cy + 0.5 * pos, self.width, self.height - pos)
+        )
 
     def radius(self):
-        return min(self.width, self.height) * 0.5
+        return self._radius
 
     def guides(self, vertical, horizontal):
         return Guides(self, vertical, horizontal)
@@ -287,7 +453,8 @@ class Rect(object):
         return Guides(
             self,
             (i / cols for i in range(1, cols + 1)),
-            (i / rows for i in range(1, rows + 1))
+            (i / rows for i in range(1, rows + 1)),
+            presorted=True
         )
 
 
@@ -295,6 +462,8 @@ class Save(object):
 
     """A context manager which Keeps calls to save() and restore() balanced."""
 
+    __slots__ = ('cr',)
+
     def __init__(self, cr):
         self.cr = cr
 
@@ -313,6 +482,9 @@ class Box(object):
     to the rectangle.
     """
 
+    __slots__ = (
+        'cr', 'center', 'bounds', 'x', 'y', 'width', 'height', 'clip', 'path')
+
     def __init__(self, cr, bounds, clip=True):
         self.cr = cr
         self.center = bounds.center
@@ -326,7 +498,13 @@ class Box(object):
     def __enter__(self):
         self.cr.save()
         if self.clip:
-            self.path = self.cr.copy_path()
+            # clip() consumes the current path, so it is saved here and
+            # restored on exit. Without a current point there is
+            # (almost always) no path, so skip copying an empty one.
+            if self.cr.has_current_point():
+                self.path = self.cr.copy_path()
+            else:
+                self.path = None
             self.cr.rectangle(self.x, self.y, self.width, self.height)
             self.cr.clip()
         self.cr.translate(*self.center)
@@ -334,7 +512,7 @@ class Box(object):
 
     def __exit__(self, unused1, unused2, unused3):
         self.cr.restore()
-        if self.clip:
+        if self.path is not None:
             self.cr.append_path(self.path)
 
 
@@ -392,31 +570,37 @@ class Guides:
     edge. In order for indexing to work correctly, horizontal and
     vertical guide positions are sorted in ascending order. To avoid
     confusion, always specify guide positions in ascending order.
+
+    If you know the positions are already in ascending order, pass
+    `presorted=True` to skip sorting them.
     """
 
-    def __init__(self, rect, vertical, horizontal):
+    def __init__(self, rect, vertical, horizontal, presorted=False):
+        if not presorted:
+            vertical = sorted(vertical)
+            horizontal = sorted(horizontal)
+        width = rect.width
+        height = rect.height
         self.rect = rect
-        self.horizontal = (
-            0,
-            *(rect.height * h for h in sorted(horizontal)),
-            rect.height
-        )
-        self.vertical = (
-            0,
-            *(rect.width * v for v in sorted(vertical)),
-            rect.width
-        )
+        self.horizontal = [0, *(height * h for h in horizontal), height]
+        self.vertical = [0, *(width * v for v in vertical), width]
+
+        # Absolute guide coordinates, so that looking up intersections
+        # and cells is just indexing.
+        nw = rect.northwest()
+        self._xs = [nw.x + v for v in self.vertical]
+        self._ys = [nw.y + h for h in self.horizontal]
 
     def intersection(self, v, h):
         """Get the intersection point for the given 2d index."""
-        return self.rect.northwest() + Point(self.vertical[v], self.horizontal[h])
+        return Point(self._xs[v], self._ys[h])
 
     def cell(self, v, h):
         """Get the table cell from the given 2d index."""
-        tl = self.intersection(v, h)
-        br = self.intersection(v + 1, h + 1)
-        size = br - tl
-        return Rect.from_top_left(tl, size.x, size.y)
+        left = self._xs[v]
+        top = self._ys[h]
+        return Rect._from_corner_xy(
+            left, top, self._xs[v + 1] - left, self._ys[h + 1] - top)
 
     def cells(self, col_first=True):
         if col_first:
@@ -429,16 +613,14 @@ class Guides:
                     yield self.cell(i, j)
 
     def column(self, h):
-        tl = self.intersection(h, 0)
-        tr = self.intersection(h + 1, 0)
-        size = tr - tl
-        return Rect.from_top_left(tl, size.x, self.rect.height)
+        left = self._xs[h]
+        return Rect._from_corner_xy(
+            left, self._ys[0], self._xs[h + 1] - left, self.rect.height)
 
     def row(self, v):
-        tl = self.intersection(0, v)
-        bl = self.intersection(0, v + 1)
-        size = bl - tl
-        return Rect.from_top_left(tl, self.rect.width, size.y)
+        top = self._ys[v]
+        return Rect._from_corner_xy(
+            self._xs[0], top, self.rect.width, self._ys[v + 1] - top)
 
     def draw(self, helpers, show_outline=True):
         """Add the guide to the current path, but do not fill or stroke.
@@ -448,10 +630,9 @@ class Guides:
         """
         if show_outline:
             helpers.rect(self.rect)
-        for h in self.horizontal[1:-1]:
-            helpers.hline(h, self.rect)
-        for v in self.vertical[1:-1]:
-            helpers.vline(v, self.rect)
+
+        helpers.hlines(self.horizontal[1:-1], self.rect)
+        helpers.vlines(self.vertical[1:-1], self.rect)
 
     # TBD: add show_indices option
     def debug(self, helpers, show_outline=True):
@@ -36,9 +36,11 @@ The following modes of operation are supported:
 - sequence   -- render each frame to a separate file in the given directory.
 - slideshow  -- render each frame as a separate page in the given file
                 (ps, pdf, and SVG only).
-"""
 
-# TBD: render to .mp4 via gstreamer?
+The `video` format pipes raw frames into `ffmpeg`, which must be
+installed. Use it with the continuous mode to render an animation
+straight to a video file, without writing intermediate images.
+"""
 
 import gi
 gi.require_version("Gtk", "3.0")
@@ -52,9 +54,11 @@ gi.require_version("PangoCairo", "1.0");
 from gi.repository import PangoCairo
 import cairo
 
+import io
 import math
-import json
 import os
+import queue
+import subprocess
 import threading
 import time
 import sys
@@ -65,6 +69,13 @@ from script import Script
 import params.text as params
 import argparse
 
+# orjson is considerably faster at decoding each frame's parameters,
+# but is optional.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 def pt_to_pixel(pts, dpi):
     return int(pts * dpi / 72.0)
@@ -109,26 +120,25 @@ class SurfaceWrapper:
     modes of operation.
     """
 
+    # Whether continuous mode may drop a line identical to the last one,
+    # when asked to with --skip-repeats.
+    can_skip_repeats = True
+
     @classmethod
     def from_args(self, args):
-        fmt = args.format
-        if   fmt == "png":    return PngSurfaceWrapper(args)
-        elif fmt == "ps":     return PsSurfaceWrapper(args)
-        elif fmt == "pdf":    return PdfSurfaceWrapper(args)
-        elif fmt == "svg":    return SvgSurfaceWrapper(args)
-        elif fmt == "script": return ScriptSurfaceWrapper(args)
-        else:                 raise  ValueError("Unpossible")
+        wrapper = FORMATS[args.format](args)
+        wrapper.skip_repeats = args.skip_repeats and wrapper.can_skip_repeats
+        return wrapper
 
     def render(self, script):
-        try:
-            self.cr.save()
-            self.cr.set_source_rgba(0, 0, 0, 0)
-            self.cr.paint()
-            script.run(self.cr, self.scale, self.window)
-        finally:
-            self.cr.restore()
-
-    def nostdin(self, script):
+        # Clearing doesn't need to sample a source, so cairo can treat
+        # this as a plain fill of the surface.
+        self.cr.set_operator(cairo.OPERATOR_CLEAR)
+        self.cr.paint()
+        self.cr.set_operator(cairo.OPERATOR_OVER)
+        script.run(self.cr, self.scale, self.window)
+
+    def nostdin(self, script, reader):
         try:
             self.render(script)
         finally:
@@ -141,33 +151,50 @@ class SurfaceWrapper:
         finally:
             self.write()
 
+    # The per-frame loops below look up their bound methods once, up
+    # front, rather than on every line of input.
+
     def continuous(self, script, reader):
-        for line in sys.stdin():
+        (update, render, write) = (reader.update, self.render, self.write)
+        # Every frame goes to the same file, so a repeated line would
+        # only rewrite what is already there -- provided the script
+        # draws the same frame for the same input. That can't be known
+        # for certain, so this is only done on request.
+        skip_repeats = self.skip_repeats and not script.animated
+        previous = None
+        for line in sys.stdin:
+            if skip_repeats and line == previous:
+                continue
+            previous = line
             try:
-                reader.update(line)
-                self.render(script)
+                update(line)
+                render(script)
             finally:
-                self.write()
+                write()
 
     def sequence(self, script, reader):
-        for (i, line) in enumerate(sys.stdin()):
-            reader.update(line)
+        (update, render, write) = (reader.update, self.render, self.write)
+        next_image = self.next_image
+        for line in sys.stdin:
+            update(line)
             try:
-                self.render(script)
+                render(script)
             finally:
-                self.write()
-            self.next_image(i)
+                write()
+            next_image()
 
     def slideshow(self, script, reader):
+        (update, render) = (reader.update, self.render)
+        next_page = self.next_page
         try:
-            for line in sys.stdin():
-                reader.update(line)
-                self.render(script)
-                self.next_page()
+            for line in sys.stdin:
+                update(line)
+                render(script)
+                next_page()
         finally:
             self.write()
 
-    def next_image(self, index):
+    def next_image(self):
         raise NotImplemented
 
     def next_page(self):
@@ -178,6 +205,30 @@ class SurfaceWrapper:
         """Defined by all subclasses."""
         raise NotImplemented
 
+    def close(self):
+        """Called once, after the last frame has been written."""
+        pass
+
+
+def create_image_surface(width, height):
+    """Return an ARGB32 surface, and the buffer which holds its pixels.
+
+    The buffer is ours rather than cairo's, so the pixels can be handed
+    to other consumers without going through `get_data()`.
+    """
+    width = int(width)
+    height = int(height)
+    stride = cairo.ImageSurface.format_stride_for_width(
+        cairo.Format.ARGB32, width)
+    buf = bytearray(stride * height)
+    surface = cairo.ImageSurface.create_for_data(
+        buf, cairo.Format.ARGB32, width, height, stride)
+    return (surface, buf)
+
+
+# Each encoder holds a full-size surface, so keep the pool small.
+MAX_ENCODERS = 4
+
 
 # Of all the output formats, this is the odd one out, because you don't create
 # PngSurface directly.
@@ -185,27 +236,97 @@ class PngSurfaceWrapper(SurfaceWrapper):
     def __init__(self, args):
         width, height = args.size
 
-        self.surface = cairo.ImageSurface(cairo.Format.ARGB32, int(width), int(height))
         self.window = Rect.from_top_left(Point(0, 0), width, height)
         self.scale = Point(args.dpi / 25.4, args.dpi / 25.4)
-        self.cr = cairo.Context(self.surface)
 
         if args.mode == "sequence":
-            self.output_dir = args.output
+            # Encoding a PNG takes about as long as rendering a frame, and
+            # libpng runs without the GIL, so hand each finished frame to
+            # a pool of encoder threads, and render the next one into a
+            # spare surface in the meantime.
+            self.template = os.path.join(args.output, "%06d.png")
             self.index = -1
-            os.mkdir(output_dir)
+            os.mkdir(args.output)
+            self.free = queue.Queue()
+            self.pending = queue.Queue()
+            self.error = None
+            self.encoders = [
+                threading.Thread(target=self.encode, daemon=True)
+                for i in range(min(os.cpu_count() or 1, MAX_ENCODERS))
+            ]
+            # One surface per encoder, plus the one being rendered.
+            for i in range(len(self.encoders) + 1):
+                surface = self.create_surface(width, height)
+                self.free.put((surface, cairo.Context(surface)))
+            for encoder in self.encoders:
+                encoder.start()
             self.next_image()
         else:
+            self.encoders = None
+            self.surface = self.create_surface(width, height)
+            self.cr = cairo.Context(self.surface)
             self.output = args.output
 
+    def create_surface(self, width, height):
+        # libpng reads the pixels through cairo, so unlike the video
+        # wrapper, there is no use for a buffer of our own.
+        return cairo.ImageSurface(cairo.Format.ARGB32, int(width), int(height))
+
     def write(self):
-        self.surface.write_to_png(self.output)
+        if self.encoders is None:
+            self.write_png(self.surface, self.output)
+        else:
+            self.pending.put((self.surface, self.cr, self.output))
+
+    def write_png(self, surface, path):
+        # Encode into memory, and hand the result to the OS in a single
+        # write, rather than letting libpng stream through stdio.
+        buf = io.BytesIO()
+        surface.write_to_png(buf)
+        with open(path, "wb", buffering=0) as f:
+            f.write(buf.getbuffer())
+
+    def encode(self):
+        """Encoder threads: write out frames until close() is called."""
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            (surface, cr, path) = item
+            try:
+                self.write_png(surface, path)
+            except Exception as e:
+                # Keep draining the queue, so that the renderer never
+                # blocks waiting for a surface; the error is raised on
+                # the main thread instead.
+                if self.error is None:
+                    self.error = e
+            finally:
+                # Only now is it safe to render into this surface again.
+                self.free.put((surface, cr))
 
     def next_image(self):
+        # Blocks until the encoder has finished with a surface.
+        (self.surface, self.cr) = self.free.get()
+        self.check()
         self.index += 1
-        self.output = os.path.join(self.output_dir, "%d.png" % self.index)
+        self.output = self.template % self.index
+
+    def close(self):
+        if self.encoders is not None:
+            for encoder in self.encoders:
+                self.pending.put(None)
+            for encoder in self.encoders:
+                encoder.join()
+            self.check()
+
+    def check(self):
+        """Re-raise the first error hit by an encoder thread, if any."""
+        (error, self.error) = (self.error, None)
+        if error is not None:
+            raise error
 
-    def slideshow(self):
+    def slideshow(self, script, reader):
         raise UserError("The PNG format does not support slideshows.")
 
 
@@ -217,7 +338,7 @@ class VectorSurfaceWrapper(SurfaceWrapper):
         self.scale = Point(72 / 25.4, 72 / 25.4)
 
         if args.mode == "sequence":
-            self.output_dir = args.output
+            self.template = os.path.join(args.output, "%06d." + args.format)
             self.index = -1
             os.mkdir(args.output)
             self.next_image()
@@ -236,7 +357,7 @@ class VectorSurfaceWrapper(SurfaceWrapper):
 
     def next_image(self):
         self.index += 1
-        self.prepare_context(self, os.path.join(self.output_dir, "%d.svg" % self.index))
+        self.prepare_context(self.template % self.index)
 
     def next_page(self):
         self.surface.show_page()
@@ -264,6 +385,61 @@ class ScriptSurfaceWrapper(VectorSurfaceWrapper):
         # XXX: cairo documents width / height as in pixels? hmm.
         return cairo.ScriptSurface(device, cairo.Content.COLOR_ALPHA, self.width, self.height)
 
+class VideoSurfaceWrapper(SurfaceWrapper):
+    """Streams each frame into an ffmpeg process as raw video.
+
+    cairo's ARGB32 pixels are native-endian words, i.e. BGRA bytes on
+    little-endian machines, which ffmpeg ingests as-is. The stride of an
+    ARGB32 surface is always 4 * width, so the surface data can be
+    written out without any conversion. Colors are premultiplied, which
+    amounts to compositing the frame over black.
+    """
+
+    # Each line is a frame of the video, even if nothing changed.
+    can_skip_repeats = False
+
+    def __init__(self, args):
+        width, height = (int(d) for d in args.size)
+
+        (self.surface, self.buf) = create_image_surface(width, height)
+        self.window = Rect.from_top_left(Point(0, 0), width, height)
+        self.scale = Point(args.dpi / 25.4, args.dpi / 25.4)
+        self.cr = cairo.Context(self.surface)
+
+        pix_fmt = "bgra" if sys.byteorder == "little" else "argb"
+        self.proc = subprocess.Popen(
+            ["ffmpeg", "-loglevel", "error", "-y",
+             "-f", "rawvideo", "-pix_fmt", pix_fmt,
+             "-s", "%dx%d" % (width, height), "-r", str(args.fps),
+             "-i", "-", args.output],
+            stdin=subprocess.PIPE)
+
+    def write(self):
+        self.surface.flush()
+        self.proc.stdin.write(self.buf)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+    def sequence(self, script, reader):
+        raise UserError("The video format does not support sequences.")
+
+    def slideshow(self, script, reader):
+        raise UserError("The video format does not support slideshows.")
+
+
+# Maps each output format to its wrapper class.
+FORMATS = {
+    "png":    PngSurfaceWrapper,
+    "ps":     PsSurfaceWrapper,
+    "pdf":    PdfSurfaceWrapper,
+    "svg":    SvgSurfaceWrapper,
+    "script": ScriptSurfaceWrapper,
+    "video":  VideoSurfaceWrapper,
+}
+
+
 class DummyReader:
     """Dummy reader for single-threaded operation.
     The wayland and gtk runners process data from stdin on a separate
@@ -278,8 +454,8 @@ class DummyReader:
     def __init__(self):
         self.env = {}
 
-    def update(line):
-        self.env = json.loads(line)
+    def update(self, line):
+        self.env = json_loads(line)
 
 
 if __name__ == "__main__":
@@ -298,7 +474,7 @@ if __name__ == "__main__":
         "-f", "--format",
         help="Output file format",
         metavar="FMT",
-        choices=("png", "ps", "pdf", "svg", "script"),
+        choices=tuple(FORMATS),
         required=True
     )
 
@@ -326,6 +502,22 @@ if __name__ == "__main__":
         type=int,
     )
 
+    parser.add_argument(
+        "-r", "--fps",
+        help="Frame rate of the output (video only).",
+        metavar="FPS",
+        default=30,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--skip-repeats",
+        help="In continuous mode, don't re-render a line identical to the "
+        "last one. Only for scripts which draw the same frame for the same "
+        "input (not video).",
+        action="store_true",
+    )
+
     parser.add_argument(
         "script",
         help="Path to the script to execute"
@@ -338,11 +530,11 @@ if __name__ == "__main__":
     wrapper = SurfaceWrapper.from_args(args)
 
     try:
-        if   args.mode == "nostdin":    wrapper.nostdin(script)
-        elif args.mode == "oneshot":    wrapper.oneshot(script,    reader)
-        elif args.mode == "continuous": wrapper.continuous(script, reader)
-        elif args.mode == "sequence":   wrapper.sequence(script,   reader)
-        elif args.mode == "slideshow":  wrapper.slideshow(script,  reader)
+        # Each mode is a method of the same name; subclasses override
+        # the ones their format doesn't support.
+        getattr(wrapper, args.mode)(script, reader)
     except UserError as e:
         print(e)
         exit(-1)
+    finally:
+        wrapper.close()
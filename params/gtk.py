@@ -16,8 +16,7 @@
 # License along with this program.  If not, see
 # <https://www.gnu.org/licenses/>.
 
-import cmath
-from collections import OrderedDict
+import builtins
 import math
 import time
 
@@ -34,17 +33,72 @@ from gi.repository import Pango
 from controller import ValueController
 from helpers import Helper, Rect, Point
 
+
+# Allowed types for `Parameter.require()`.
+_NUMBER = frozenset((int, float))
+_NUMBER_OR_NONE = frozenset((int, float, type(None)))
+_SCALAR = frozenset((int, float, complex))
+_BOOL = frozenset((bool,))
+_STR = frozenset((str,))
+_STR_OR_NONE = frozenset((str, type(None)))
+_DICT = frozenset((dict,))
+_SEQUENCE = frozenset((list, tuple))
+_ALTERNATIVES = frozenset((tuple, list, dict))
+_IMAGE = frozenset((str, cairo.Pattern, type(None)))
+_POINT_OR_NONE = frozenset((Point, type(None)))
+
+
+def draw_dial(widget, cr, ring, angle):
+    """Draw the dial used by the Angle and Infinite parameters.
+
+    The outer ring only changes with the size of the widget, so it is
+    rendered once into an offscreen surface and painted on later draws.
+    `ring` is the value returned by the previous call, or None; the
+    caller keeps it, and resets it to None when the widget is resized.
+    """
+    alloc = widget.get_allocation()
+    window = Rect.from_top_left(Point(0, 0), alloc.width, alloc.height)
+    bounds = window.inset(5)
+    radius = min(bounds.width, bounds.height) * 0.5
+
+    if ring is None:
+        ring = cr.get_target().create_similar(
+            cairo.Content.COLOR_ALPHA, alloc.width, alloc.height)
+        ring_cr = cairo.Context(ring)
+        Helper(ring_cr).circle(bounds.center, radius)
+        ring_cr.set_line_width(2.5)
+        ring_cr.stroke()
+
+    cr.save()
+    cr.set_source_surface(ring, 0, 0)
+    cr.paint()
+    cr.restore()
+
+    helper = Helper(cr)
+    with helper.box(bounds, clip=False):
+        cr.rotate(angle)
+        helper.circle(Point(radius/2, 0), radius/4)
+        cr.fill()
+    return ring
+
+
 class Parameter(object):
 
     """A uniform interface for creating live-adjustable parameters."""
 
-    def require(self, value, allowed_types):
+    __slots__ = ()
+
+    @staticmethod
+    def require(value, allowed_types):
         """Raise an error if `value` is not one of `allowed_types`.
 
-        `allowed_types` may be a tuple or a single type.
+        `allowed_types` is a frozenset of types. Exact matches are a
+        single set lookup; instances of subclasses are still accepted.
         """
 
-        if not isinstance(value, allowed_types):
+        if type(value) in allowed_types:
+            return
+        if not isinstance(value, tuple(allowed_types)):
             raise TypeError("Expected one of %s, got %r." % (
                 ", ".join(repr(t) for t in allowed_types),
                 value
@@ -70,6 +124,15 @@ class Parameter(object):
         """
         return self.default
 
+    def connectChanged(self, callback):
+        """Arrange for `callback` to be called when the value changes.
+
+        Subtypes with a widget should override this to connect
+        `callback` to whichever signal reports a new value, and return
+        True. Otherwise, the value is read again for every frame.
+        """
+        return False
+
 
 class AngleParameter(Parameter):
 
@@ -79,8 +142,12 @@ class AngleParameter(Parameter):
     mousedown and the current mouse position.
     """
 
+    __slots__ = (
+        'default', 'adjustment', 'saved_value', 'format', 'label', 'text',
+        'vc', 'ring')
+
     def __init__(self, default, format="%.2f"):
-        self.require(default, (float, int, None))
+        self.require(default, _NUMBER_OR_NONE)
         self.default = default
         self.adjustment = Gtk.Adjustment(
             0,
@@ -91,7 +158,9 @@ class AngleParameter(Parameter):
         self.adjustment.set_value(default)
         self.format = format
         self.label = None
+        self.text = None
         self.vc = None
+        self.ring = None
 
     def makeWidget(self):
         entry = Gtk.SpinButton.new(self.adjustment, 1/3600.0, 3)
@@ -102,6 +171,7 @@ class AngleParameter(Parameter):
         widget = Gtk.DrawingArea()
         widget.set_size_request(30, 30)
         widget.connect('draw', self.draw)
+        widget.connect('size-allocate', self.resize)
         self.vc = ValueController(widget, self)
         self.label = Gtk.Label(str(self.adjustment.get_value()))
         box = Gtk.Box(Gtk.Orientation.HORIZONTAL)
@@ -116,25 +186,29 @@ class AngleParameter(Parameter):
     def getValue(self):
         return self.adjustment.get_value()
 
+    def connectChanged(self, callback):
+        self.adjustment.connect("value-changed", callback)
+        return True
+
     def updateValue(self, cursor):
-        # (ab)use complex built-in to compute the angle of the mouse.
-        angle = cmath.polar(complex(cursor.pos.x, cursor.pos.y))[1]
+        angle = math.atan2(cursor.pos.y, cursor.pos.x)
         value = (angle + self.saved_value) % (2 * math.pi)
         self.adjustment.set_value(value)
-        self.label.set_text(self.format % value)
+        self.setLabel(self.format % value)
+
+    def setLabel(self, text):
+        # Most motion events don't change the displayed value; don't
+        # make Gtk re-layout the label for those.
+        if text != self.text:
+            self.text = text
+            self.label.set_text(text)
 
     def draw(self, widget, cr):
-        helper = Helper(cr)
-        alloc = widget.get_allocation()
-        window = Rect.from_top_left(Point(0, 0), alloc.width, alloc.height)
-        with helper.box(window.inset(5), clip=False) as bounds:
-            radius = min(bounds.width, bounds.height) * 0.5
-            helper.circle(bounds.center, radius)
-            cr.set_line_width(2.5)
-            cr.stroke()
-            cr.rotate(self.adjustment.get_value())
-            helper.circle(Point(radius/2, 0), radius/4)
-            cr.fill()
+        angle = self.adjustment.get_value()
+        self.ring = draw_dial(widget, cr, self.ring, angle)
+
+    def resize(self, widget, allocation):
+        self.ring = None
 
 
 class ChoiceParameter(Parameter):
@@ -142,10 +216,14 @@ class ChoiceParameter(Parameter):
     """A parameter representing a choice of alternatives.
     """
 
+    __slots__ = (
+        'alternatives', 'with_entry', 'value_col', 'store', 'widget',
+        'default_row', 'values', 'active')
+
     def __init__(self, alternatives, default, with_entry=False):
         # XXX: should be any seq
-        self.require(alternatives, (tuple, list, dict))
-        self.require(with_entry, bool)
+        self.require(alternatives, _ALTERNATIVES)
+        self.require(with_entry, _BOOL)
         self.alternatives = alternatives
 
         if not default in alternatives:
@@ -160,7 +238,7 @@ class ChoiceParameter(Parameter):
             self.value_col = 0
 
             for key in alternatives:
-                self.require(key, str)
+                self.require(key, _STR)
 
             if not all(isinstance(v, t) for v in items):
                 raise TypeError("All alternatives must be the same type")
@@ -185,6 +263,13 @@ class ChoiceParameter(Parameter):
                 if item == default:
                     self.default_row = i
 
+        # The value for each row of the store, in order, and the index
+        # of the active row, so that getValue() needn't query Gtk.
+        self.values = list(alternatives.values()
+                           if isinstance(alternatives, dict)
+                           else alternatives)
+        self.active = self.default_row
+
     def makeWidget(self):
         if self.with_entry:
             self.widget = Gtk.ComboBox.new_with_entry()
@@ -196,31 +281,37 @@ class ChoiceParameter(Parameter):
             self.widget.add_attribute(cr, "text", 0)
         self.widget.set_model(self.store)
         self.widget.set_active(self.default_row)
+        self.widget.connect("changed", self.update)
 
         return self.widget
 
+    def update(self, *unused):
+        self.active = self.widget.get_active()
+
     def getValue(self):
-        i = self.widget.get_active_iter()
-        if i is not None:
-            if isinstance(self.alternatives, dict):
-                return self.alternatives[self.store[i][self.value_col]]
-            else:
-                return self.alternatives[self.store[i][self.value_col]]
+        if self.active >= 0:
+            return self.values[self.active]
         else:
             return None
 
+    def connectChanged(self, callback):
+        self.widget.connect("changed", callback)
+        return True
+
 
 # TBD: images, gradients, stipples, etc.
 class ColorParameter(Parameter):
 
     """An RGBA Color value."""
 
+    __slots__ = ('default', 'widget')
+
     def __init__(self, r=0, g=0, b=0, a=1.0):
         self.default = (r, g, b, a)
-        self.require(r, (int, float))
-        self.require(g, (int, float))
-        self.require(b, (int, float))
-        self.require(a, (int, float))
+        self.require(r, _NUMBER)
+        self.require(g, _NUMBER)
+        self.require(b, _NUMBER)
+        self.require(a, _NUMBER)
 
     def makeWidget(self):
         self.widget = Gtk.ColorButton.new_with_rgba(Gdk.RGBA(*self.default))
@@ -231,6 +322,10 @@ class ColorParameter(Parameter):
         r, g, b = gdk_color.to_floats()
         return cairo.SolidPattern(r, g, b, self.widget.get_alpha())
 
+    def connectChanged(self, callback):
+        self.widget.connect("color-set", callback)
+        return True
+
 
 class CustomParameter(Parameter):
     """A parameter that YOU have implemented."""
@@ -242,8 +337,10 @@ class FontParameter(Parameter):
 
     """An easy way to chose a specific font."""
 
+    __slots__ = ('default', 'value', 'widget')
+
     def __init__(self, default="monospace"):
-        self.require(default, (str, type(None)))
+        self.require(default, _STR_OR_NONE)
         self.default = default
         self.value = Pango.FontDescription(default)
         self.widget = None
@@ -266,6 +363,10 @@ class FontParameter(Parameter):
     def getValue(self):
         return self.value
 
+    def connectChanged(self, callback):
+        self.widget.connect("font-set", callback)
+        return True
+
 
 class ImageParameter(Parameter):
 
@@ -274,9 +375,11 @@ class ImageParameter(Parameter):
     If loading succeeds, the will be converted to a cairo.ImagePattern.
     """
 
+    __slots__ = ('default', 'value', 'widget')
+
     def __init__(self, default=None):
         # Default can be a fallback pattern, or a path to an image.
-        self.require(default, (str, cairo.Pattern, type(None)))
+        self.require(default, _IMAGE)
         self.default = default
         self.value = default
 
@@ -303,20 +406,30 @@ class ImageParameter(Parameter):
     def getValue(self):
         return self.value
 
+    def connectChanged(self, callback):
+        self.widget.connect("file-set", callback)
+        return True
+
 
 class InfiniteParameter(Parameter):
 
     """A scalar value that is not constrained to a finite interval."""
 
+    __slots__ = (
+        'default', 'value', 'saved_value', 'rate', 'format', 'label', 'text',
+        'vc', 'ring')
+
     def __init__(self, default, rate=0.125, format="%.2f"):
-        self.require(default, (float, int, None))
+        self.require(default, _NUMBER_OR_NONE)
         self.default = default
         self.value = default
         self.saved_value = default
         self.rate = rate
         self.format = format
         self.label = None
+        self.text = None
         self.vc = None
+        self.ring = None
 
     def makeWidget(self):
         entry = Gtk.Entry()
@@ -326,6 +439,7 @@ class InfiniteParameter(Parameter):
         widget = Gtk.DrawingArea()
         widget.set_size_request(30, 30)
         widget.connect('draw', self.draw)
+        widget.connect('size-allocate', self.resize)
         self.vc = ValueController(widget, self)
         self.label = Gtk.Label(str(self.value))
         box = Gtk.Box(Gtk.Orientation.HORIZONTAL)
@@ -340,31 +454,36 @@ class InfiniteParameter(Parameter):
     def getValue(self):
         return float(self.label.get_text())
 
+    def connectChanged(self, callback):
+        self.label.connect("notify::label", callback)
+        return True
+
     def updateValue(self, cursor):
         value = self.saved_value - self.rate * cursor.rel.y
         self.value = value
-        self.label.set_text(self.format % value)
+        self.setLabel(self.format % value)
+
+    def setLabel(self, text):
+        # See AngleParameter.setLabel.
+        if text != self.text:
+            self.text = text
+            self.label.set_text(text)
 
     def draw(self, widget, cr):
-        helper = Helper(cr)
-        alloc = widget.get_allocation()
-        window = Rect.from_top_left(Point(0, 0), alloc.width, alloc.height)
-        with helper.box(window.inset(5), clip=False) as bounds:
-            radius = min(bounds.width, bounds.height) * 0.5
-            helper.circle(bounds.center, radius)
-            cr.set_line_width(2.5)
-            cr.stroke()
-            cr.rotate(self.value)
-            helper.circle(Point(radius/2, 0), radius/4)
-            cr.fill()
+        self.ring = draw_dial(widget, cr, self.ring, self.value)
+
+    def resize(self, widget, allocation):
+        self.ring = None
 
 
 class NumericParameter(Parameter):
 
     """A scalar numeric value, with a finite range."""
 
+    __slots__ = ('lower', 'upper', 'step', 'default', 'adjustment')
+
     def __init__(self, lower, upper, step=1/128.0, default=0.5):
-        allowed = (int, float, complex)
+        allowed = _SCALAR
         self.require(lower, allowed)
         self.require(upper, allowed)
         self.require(default, allowed)
@@ -398,13 +517,19 @@ class NumericParameter(Parameter):
     def getValue(self):
         return self.adjustment.get_value()
 
+    def connectChanged(self, callback):
+        self.adjustment.connect("value-changed", callback)
+        return True
+
 
 class PointParameter(Parameter):
 
     """An (x,y) pair, returned as a helpers.Point instance."""
 
+    __slots__ = ('default',)
+
     def __init__(self, default=None):
-        self.require(default, (Point, None))
+        self.require(default, _POINT_OR_NONE)
         self.default = default
 
 
@@ -426,20 +551,25 @@ class ScriptParameter(Parameter):
     `dict` containing any values the child script requires.
     """
 
+    __slots__ = ()
+
     def __init__(self, default=None, stdin=None):
         # XXX: should be any seq
-        self.require(default, str)
-        self.require(stdin, dict)
+        self.require(default, _STR)
+        self.require(stdin, _DICT)
 
 
 class TableParameter(Parameter):
 
     """An arbitrary of values, which may themelves be tuples."""
 
+    __slots__ = ('row_type', 'default')
+
     def __init__(self, row_type, default=None):
-        self.require(row_type, (list, tuple))
+        self.require(row_type, _SEQUENCE)
         for item in row_type:
-            self.require(item, (str, int, float, long, Point, Color))
+            self.require(
+                item, frozenset((str, int, float, long, Point, Color)))
         self.row_type = row_type
         self.default = default
 
@@ -448,9 +578,11 @@ class TextParameter(Parameter):
 
     """An arbitrary text string."""
 
+    __slots__ = ('default', 'multiline', 'widget')
+
     def __init__(self, default=None, multiline=False):
-        self.require(default, (str, None))
-        self.require(multiline, bool)
+        self.require(default, _STR_OR_NONE)
+        self.require(multiline, _BOOL)
         self.default = default
         self.multiline = multiline
         self.widget = None
@@ -477,13 +609,22 @@ class TextParameter(Parameter):
         else:
             return self.widget.get_text()
 
+    def connectChanged(self, callback):
+        if self.multiline:
+            self.widget.get_buffer().connect("changed", callback)
+        else:
+            self.widget.connect("changed", callback)
+        return True
+
 
 class ToggleParameter(Parameter):
 
     """A parameter representing a binary choice."""
 
+    __slots__ = ('default', 'widget')
+
     def __init__(self, default):
-        self.require(default, bool)
+        self.require(default, _BOOL)
         self.default = default
 
     def makeWidget(self):
@@ -494,15 +635,61 @@ class ToggleParameter(Parameter):
     def getValue(self):
         return self.widget.get_active()
 
+    def connectChanged(self, callback):
+        self.widget.connect("toggled", callback)
+        return True
+
 
 class ParameterGroup(object):
 
     """Manages the parameters required by your script."""
 
+    __slots__ = (
+        'params', 'names', 'getters', 'live', 'size_group', 'listbox',
+        'values', 'dirty', 'helper')
+
     entry_group = None
 
+    # The parts of the script environments which never change.
+    _init_env = {
+        '__builtins__': builtins,
+        '__name__': 'init',
+        'cairo': cairo,
+        'Angle': AngleParameter,
+        'Choice': ChoiceParameter,
+        'Color': ColorParameter,
+        'Custom': CustomParameter,
+        'Font': FontParameter,
+        'Image': ImageParameter,
+        'Infinite': InfiniteParameter,
+        'Numeric': NumericParameter,
+        'Point': PointParameter,
+        'Script': ScriptParameter,
+        'Table': TableParameter,
+        'Text': TextParameter,
+        'Toggle': ToggleParameter,
+    }
+
+    _render_env = {
+        '__builtins__': builtins,
+        '__name__': 'render',
+        'cairo': cairo,
+        'math': math,
+        'Point': Point,
+        'Rect': Rect,
+    }
+
     def __init__(self):
-        self.params = OrderedDict()
+        self.params = {}
+        # Parallel to `params`: each name, and its bound getValue().
+        self.names = []
+        self.getters = []
+        # The (name, getValue) pairs whose changes no signal reports,
+        # which must be read every time.
+        self.live = []
+        self.values = None
+        self.dirty = True
+        self.helper = None
 
     def define(self, name, param):
         """Define a new parameter for later use in the a user script."""
@@ -510,6 +697,11 @@ class ParameterGroup(object):
         if name in self.params:
             raise ValueError("Parameter %s already defined" % name)
         self.params[name] = param
+        self.names.append(name)
+        self.getters.append(param.getValue)
+        # Until its widget is made, nothing reports changes.
+        self.live.append((name, param.getValue))
+        self.dirty = True
 
     def makeWidgets(self, container):
         """Create a widget for each parameter, adding them into `container`.
@@ -537,17 +729,22 @@ class ParameterGroup(object):
         ParameterGroup.entry_group = Gtk.SizeGroup(
             Gtk.SizeGroupMode.HORIZONTAL)
 
+        # Build the rows into the detached listbox, and only show it
+        # once everything has been packed, so that Gtk performs a
+        # single style / size-allocation pass for the whole group.
+        listbox.freeze_child_notify()
+        self.live = []
         for name, param in self.params.items():
             row = Gtk.ListBoxRow()
             box = Gtk.Box(Gtk.Orientation.HORIZONTAL, spacing=6)
             label = Gtk.Label.new("<b><tt>%s</tt></b>" % name)
             widget = param.makeWidget()
+            if not param.connectChanged(self.invalidate):
+                self.live.append((name, param.getValue))
 
-            box.show()
             box.set_border_width(5)
             row.add(box)
 
-            label.show()
             label.set_use_markup(True)
             label.set_justify(Gtk.Justification.LEFT)
             box.pack_start(label, False, True, 12)
@@ -555,58 +752,64 @@ class ParameterGroup(object):
             self.size_group.add_widget(label)
             box.pack_end(widget, True, True, 12)
             listbox.add(row)
+        listbox.thaw_child_notify()
 
+        # Swap the new listbox in for the old one in one step.
+        container.freeze_child_notify()
         for child in container.get_children():
             child.destroy()
-
         container.add(listbox)
+        container.thaw_child_notify()
         container.show_all()
         self.listbox = listbox
+        self.dirty = True
+
+    def invalidate(self, *unused):
+        """Discard the cached values, after a widget has changed."""
+        self.dirty = True
 
     def getValues(self):
-        """Get the current value for each parameter, as dict."""
-        return {name: param.getValue()
-                for name, param in self.params.items()}
+        """Get the current value for each parameter, as dict.
+
+        The result is cached until one of the widgets changes, except
+        for parameters without a change signal, which are read every
+        time. It must not be modified by the caller.
+        """
+        if self.dirty:
+            self.values = {name: getter()
+                           for name, getter in zip(self.names, self.getters)}
+            self.dirty = False
+        else:
+            for name, getter in self.live:
+                self.values[name] = getter()
+        return self.values
 
     def getInitEnv(self):
-        return {
-            '__name__': 'init',
-            'cairo': cairo,
-            'params': self,
-            'Angle': AngleParameter,
-            'Choice': ChoiceParameter,
-            'Color': ColorParameter,
-            'Custom': CustomParameter,
-            'Font': FontParameter,
-            'Image': ImageParameter,
-            'Infinite': InfiniteParameter,
-            'Numeric': NumericParameter,
-            'Point': PointParameter,
-            'Script': ScriptParameter,
-            'Table': TableParameter,
-            'Text': TextParameter,
-            'Toggle': ToggleParameter,
-        }
+        ret = self._init_env.copy()
+        ret['params'] = self
+        return ret
+
+    def getHelper(self, cr):
+        """Return a Helper for `cr`, reusing the one from the last frame."""
+        if self.helper is None:
+            self.helper = Helper(cr)
+        else:
+            self.helper.cr = cr
+        return self.helper
 
     def getRenderEnv(self, cr, scale, window, env):
         """Get the global environment for script rendering.
 
         This will include all defined parameters plus some useful globals.
         """
-        values = self.getValues()
+        values = dict(self.getValues())
         values.update(env)
-        ret = {
-            'cr': cr,
-            'cairo': cairo,
-            'math': math,
-            'window': window,
-            'scale_mm': scale,
-            'helpers': Helper(cr),
-            'Point': Point,
-            'Rect': Rect,
-            'time': time.time(),
-            '__name__': 'render',
-            'params': values,
-        }
+        ret = self._render_env.copy()
+        ret['cr'] = cr
+        ret['window'] = window
+        ret['scale_mm'] = scale
+        ret['helpers'] = self.getHelper(cr)
+        ret['time'] = time.time()
+        ret['params'] = values
         ret.update(values)
         return ret
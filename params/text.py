@@ -22,26 +22,58 @@ import gi
 from gi.repository import Pango
 import cairo
 
+import builtins
 import cmath
-from collections import OrderedDict
+import functools
 import math
 import time
 import os
+import string
 
 from helpers import Helper, Rect, Point
 
 
+# Allowed types for `Parameter.require()`.
+_NUMBER = frozenset((int, float))
+_NUMBER_OR_NONE = frozenset((int, float, type(None)))
+_SCALAR = frozenset((int, float, complex))
+_BOOL = frozenset((bool,))
+_STR = frozenset((str,))
+_STR_OR_NONE = frozenset((str, type(None)))
+_DICT = frozenset((dict,))
+_SEQUENCE = frozenset((list, tuple))
+_ALTERNATIVES = frozenset((tuple, list, dict))
+_IMAGE = frozenset((str, cairo.Pattern, type(None)))
+_POINT_OR_NONE = frozenset((Point, type(None)))
+
+# The accepted spellings for `ToggleParameter`.
+_TOGGLE = {"true": True, "false": False}
+
+# The characters accepted by `parse_color()`.
+_HEXDIGITS = frozenset(string.hexdigits)
+
+
 class Parameter(object):
 
     """A uniform interface for creating parameters from the environment."""
 
-    def require(self, value, allowed_types):
+    __slots__ = ()
+
+    # Whether a parsed value may be reused when its text is unchanged.
+    # Parameters whose values scripts can modify should disable this.
+    cache_parsed = True
+
+    @staticmethod
+    def require(value, allowed_types):
         """Raise an error if `value` is not one of `allowed_types`.
 
-        `allowed_types` may be a tuple or a single type.
+        `allowed_types` is a frozenset of types. Exact matches are a
+        single set lookup; instances of subclasses are still accepted.
         """
 
-        if not isinstance(value, allowed_types):
+        if type(value) in allowed_types:
+            return
+        if not isinstance(value, tuple(allowed_types)):
             raise TypeError("Expected one of %s, got %r." % (
                 ", ".join(repr(t) for t in allowed_types),
                 value
@@ -59,8 +91,10 @@ class AngleParameter(Parameter):
     mousedown and the current mouse position.
     """
 
+    __slots__ = ('default',)
+
     def __init__(self, default, format="%.2f"):
-        self.require(default, (float, int, None))
+        self.require(default, _NUMBER_OR_NONE)
         self.default = self.parse(default)
 
     def parse(self, text):
@@ -72,15 +106,23 @@ class ChoiceParameter(Parameter):
     """A parameter representing a choice of alternatives.
     """
 
+    __slots__ = ('alternatives', 'lookup', 'with_entry', 'default')
+
     def __init__(self, alternatives, default, with_entry=False):
         # XXX: should be any seq
-        self.require(alternatives, (tuple, list, dict))
-        self.require(with_entry, bool)
+        self.require(alternatives, _ALTERNATIVES)
+        self.require(with_entry, _BOOL)
         self.alternatives = alternatives
 
         if isinstance(alternatives, dict):
+            self.lookup = alternatives
             self.default = alternatives[default]
         else:
+            # A sequence of alternatives gives the index of the choice,
+            # as for the default.
+            self.lookup = {}
+            for (i, alternative) in enumerate(alternatives):
+                self.lookup.setdefault(alternative, i)
             self.default = alternatives.index(default)
 
         if not default in alternatives:
@@ -89,10 +131,11 @@ class ChoiceParameter(Parameter):
         self.with_entry = with_entry
 
     def parse(self, text):
-        if text not in self.alternatives:
+        try:
+            return self.lookup[text]
+        except (KeyError, TypeError):
             raise ValueError(
-                "{} is not one of {}".format((text, self.alternatives)))
-        return self.alternatives[text]
+                "{} is not one of {}".format(text, self.alternatives))
 
 
 # TBD: images, gradients, stipples, etc.
@@ -100,23 +143,37 @@ class ColorParameter(Parameter):
 
     """An RGBA Color value."""
 
+    __slots__ = ('default',)
+
     def __init__(self, r=0, g=0, b=0, a=1.0):
-        self.require(r, (int, float))
-        self.require(g, (int, float))
-        self.require(b, (int, float))
-        self.require(a, (int, float))
+        self.require(r, _NUMBER)
+        self.require(g, _NUMBER)
+        self.require(b, _NUMBER)
+        self.require(a, _NUMBER)
         self.default = cairo.SolidPattern(r, g, b, a)
 
     def parse(self, text):
-        # TBD, other color formats
-        if not len(text) == 8:
-            raise ValueError("Could not parse as color: " + text)
+        return parse_color(text)
 
-        a = int(text[0:2], 16) / 0xFF
-        r = int(text[2:4], 16) / 0xFF
-        g = int(text[4:6], 16) / 0xFF
-        b = int(text[6:8], 16) / 0xFF
-        return cairo.SolidPattern(r, g, b, a)
+
+# The same color is usually parsed every frame, so keep the patterns
+# around. SolidPatterns can't be modified once created, so sharing
+# them between frames is safe.
+@functools.lru_cache(maxsize=256)
+def parse_color(text):
+    # TBD, other color formats
+    # int() alone would also accept a sign, whitespace, underscores
+    # and a "0x" prefix.
+    if not (len(text) == 8 and _HEXDIGITS.issuperset(text)):
+        raise ValueError("Could not parse as color: " + text)
+
+    # Parse all four channels at once, then pick out the bytes.
+    v = int(text, 16)
+    return cairo.SolidPattern(
+        ((v >> 16) & 0xFF) / 0xFF,
+        ((v >> 8) & 0xFF) / 0xFF,
+        (v & 0xFF) / 0xFF,
+        ((v >> 24) & 0xFF) / 0xFF)
 
 
 class CustomParameter(Parameter):
@@ -128,8 +185,13 @@ class FontParameter(Parameter):
 
     """An easy way to chose a specific font."""
 
+    __slots__ = ('default',)
+
+    # FontDescriptions are mutable.
+    cache_parsed = False
+
     def __init__(self, default="monospace"):
-        self.require(default, (str, type(str)))
+        self.require(default, _STR_OR_NONE)
         self.default = self.parse(default)
 
     def parse(self, text):
@@ -143,9 +205,15 @@ class ImageParameter(Parameter):
     If loading succeeds, the will be converted to a cairo.ImagePattern.
     """
 
+    __slots__ = ('default',)
+
+    # Scripts routinely set the matrix, extend and filter of the
+    # pattern, and the file may change on disk.
+    cache_parsed = False
+
     def __init__(self, default=None):
         # Default can be a fallback pattern, or a path to an image.
-        self.require(default, (str, cairo.Pattern, type(None)))
+        self.require(default, _IMAGE)
         self.default = self.parse(default)
 
     def parse(self, text):
@@ -156,10 +224,18 @@ class InfiniteParameter(Parameter):
 
     """A scalar value that is not constrained to a finite interval."""
 
+    __slots__ = ('type', 'default')
+
     def __init__(self, default, rate=0.125, format="%.2f"):
-        self.require(default, (float, int, None))
-        self.type = type(default)
-        self.default = self.parse(default)
+        self.require(default, _NUMBER_OR_NONE)
+        # Values from the environment are parsed as floats if there is
+        # no default to take the type from.
+        if default is None:
+            self.type = float
+            self.default = None
+        else:
+            self.type = type(default)
+            self.default = self.parse(default)
 
     def parse(self, text):
         return self.type(text)
@@ -169,8 +245,10 @@ class NumericParameter(Parameter):
 
     """A scalar numeric value, with a finite range."""
 
+    __slots__ = ('lower', 'upper', 'step', 'type', 'default')
+
     def __init__(self, lower, upper, step=1/128.0, default=0.5):
-        allowed = (int, float, complex)
+        allowed = _SCALAR
         self.require(lower, allowed)
         self.require(upper, allowed)
         self.require(default, allowed)
@@ -194,8 +272,13 @@ class PointParameter(Parameter):
 
     """An (x,y) pair, returned as a helpers.Point instance."""
 
+    __slots__ = ('default',)
+
+    # Points are mutable.
+    cache_parsed = False
+
     def __init__(self, default=None):
-        self.require(default, (Point, None))
+        self.require(default, _POINT_OR_NONE)
         self.default = self.parse(default)
 
     def parse(self, text):
@@ -220,10 +303,12 @@ class ScriptParameter(Parameter):
     `dict` containing any values the child script requires.
     """
 
+    __slots__ = ()
+
     def __init__(self, default=None, stdin=None):
         # XXX: should be any seq
-        self.require(default, str)
-        self.require(stdin, dict)
+        self.require(default, _STR)
+        self.require(stdin, _DICT)
         raise NotImplementedError
 
 
@@ -231,10 +316,13 @@ class TableParameter(Parameter):
 
     """An arbitrary of values, which may themelves be tuples."""
 
+    __slots__ = ('row_type', 'default')
+
     def __init__(self, row_type, default=None):
-        self.require(row_type, (list, tuple))
+        self.require(row_type, _SEQUENCE)
         for item in row_type:
-            self.require(item, (str, int, float, long, Point, Color))
+            self.require(
+                item, frozenset((str, int, float, long, Point, Color)))
         self.row_type = row_type
         self.default = default
         raise NotImplementedError
@@ -244,9 +332,11 @@ class TextParameter(Parameter):
 
     """An arbitrary text string."""
 
+    __slots__ = ('multiline', 'default')
+
     def __init__(self, default=None, multiline=False):
-        self.require(default, (str, None))
-        self.require(multiline, bool)
+        self.require(default, _STR_OR_NONE)
+        self.require(multiline, _BOOL)
         self.multiline = multiline
         self.default = default
 
@@ -258,27 +348,64 @@ class ToggleParameter(Parameter):
 
     """A parameter representing a binary choice."""
 
+    __slots__ = ('default',)
+
     def __init__(self, default):
-        self.require(default, bool)
+        self.require(default, _BOOL)
         self.default = default
 
     def parse(self, text):
-        if text == "true":
-            return True
-        elif text == "false":
-            return False
-
-        raise ValueError("Could not parse {} as bool".format(text))
+        try:
+            return _TOGGLE[text]
+        except KeyError:
+            raise ValueError("Could not parse {} as bool".format(text))
 
 
 class ParameterGroup(object):
 
     """Manages the parameters required by your script."""
 
+    __slots__ = ('params', 'parsed', 'environ', 'helper')
+
     entry_group = None
 
+    # The parts of the script environments which never change.
+    _init_env = {
+        '__builtins__': builtins,
+        '__name__': 'init',
+        'cairo': cairo,
+        'Angle': AngleParameter,
+        'Choice': ChoiceParameter,
+        'Color': ColorParameter,
+        'Custom': CustomParameter,
+        'Font': FontParameter,
+        'Image': ImageParameter,
+        'Infinite': InfiniteParameter,
+        'Numeric': NumericParameter,
+        'Point': PointParameter,
+        'Script': ScriptParameter,
+        'Table': TableParameter,
+        'Text': TextParameter,
+        'Toggle': ToggleParameter,
+    }
+
+    _render_env = {
+        '__builtins__': builtins,
+        '__name__': 'render',
+        'cairo': cairo,
+        'math': math,
+        'Point': Point,
+        'Rect': Rect,
+    }
+
     def __init__(self):
-        self.params = OrderedDict()
+        self.params = {}
+        # name -> (text, value) for the last value parsed.
+        self.parsed = {}
+        # Nothing outside this process can change its environment, so
+        # read it once rather than decoding os.environ every frame.
+        self.environ = dict(os.environ)
+        self.helper = None
 
     def define(self, name, param):
         """Define a new parameter for later use in the a user script."""
@@ -289,53 +416,53 @@ class ParameterGroup(object):
 
     def getValues(self, env):
         """Get the current value for each parameter, as dict."""
+        environ = self.environ
         return {
-            name: self.getParamValue(name, param, env)
+            name: self.getParamValue(name, param, env, environ)
             for name, param in self.params.items()
         }
 
-    def getParamValue(self, name, param, env):
-        if name in os.environ:
-            return param.parse(os.environ[name])
-        elif name in env:
-            return param.parse(env[name])
-        else:
-            return param.default
+    def getParamValue(self, name, param, env, environ=os.environ):
+        text = environ.get(name)
+        if text is None:
+            if name not in env:
+                return param.default
+            text = env[name]
+
+        # Most frames repeat the previous frame's values; only parse
+        # the ones which have changed. The types must match too, since
+        # True == 1 == 1.0.
+        cached = self.parsed.get(name)
+        if (cached is not None and type(cached[0]) is type(text)
+                and cached[0] == text):
+            return cached[1]
+
+        value = param.parse(text)
+        if param.cache_parsed:
+            self.parsed[name] = (text, value)
+        return value
 
     def getInitEnv(self):
-        return {
-            '__name__': 'init',
-            'cairo': cairo,
-            'params': self,
-            'Angle': AngleParameter,
-            'Choice': ChoiceParameter,
-            'Color': ColorParameter,
-            'Custom': CustomParameter,
-            'Font': FontParameter,
-            'Image': ImageParameter,
-            'Infinite': InfiniteParameter,
-            'Numeric': NumericParameter,
-            'Point': PointParameter,
-            'Script': ScriptParameter,
-            'Table': TableParameter,
-            'Text': TextParameter,
-            'Toggle': ToggleParameter,
-        }
+        ret = self._init_env.copy()
+        ret['params'] = self
+        return ret
+
+    def getHelper(self, cr):
+        """Return a Helper for `cr`, reusing the one from the last frame."""
+        if self.helper is None:
+            self.helper = Helper(cr)
+        else:
+            self.helper.cr = cr
+        return self.helper
 
     def getRenderEnv(self, cr, scale, window, env):
         values = self.getValues(env)
-        ret = {
-            'cr': cr,
-            'cairo': cairo,
-            'math': math,
-            'window': window,
-            'scale_mm': scale,
-            'helpers': Helper(cr),
-            'Point': Point,
-            'Rect': Rect,
-            'time': time.time(),
-            '__name__': 'render',
-            'params': values
-        }
+        ret = self._render_env.copy()
+        ret['cr'] = cr
+        ret['window'] = window
+        ret['scale_mm'] = scale
+        ret['helpers'] = self.getHelper(cr)
+        ret['time'] = time.time()
+        ret['params'] = values
         ret.update(values)
         return ret
@@ -18,12 +18,54 @@
 # <https://www.gnu.org/licenses/>.
 
 import traceback
+import types
 
 import cairo
 import helpers
 import sys
 
 
+# The most recently compiled code for each script path, and the source
+# it was compiled from. The sandbox reloads a script at other times than
+# when it has changed on disk. The source itself is the key: a reload
+# can catch a file mid-save, and the final write may land with the same
+# mtime.
+_compiled = {}
+
+
+def compile_script(path):
+    """Return the code object for `path`, compiling it if it changed."""
+    with open(path, "rb") as f:
+        source = f.read()
+
+    cached = _compiled.get(path)
+    if cached is not None and cached[0] == source:
+        return cached[1]
+
+    prog = compile(source, path, "exec")
+    _compiled[path] = (source, prog)
+    return prog
+
+
+# Scripts referring to any of these probably draw something new every
+# frame.
+ANIMATION_NAMES = ("time", "random")
+
+# The types of global whose values are compared between runs, to catch
+# scripts which draw something new for other reasons.
+_PLAIN = frozenset((
+    int, float, complex, str, bytes, bool, type(None), tuple,
+    helpers.Point, helpers.Rect))
+
+
+def uses_name(code, name):
+    """Whether `code`, or any function defined within it, refers to `name`."""
+    return name in code.co_names or any(
+        uses_name(const, name)
+        for const in code.co_consts
+        if isinstance(const, types.CodeType))
+
+
 class Script(object):
 
     """Loads and runs the script given at `path`."""
@@ -38,24 +80,89 @@ class Script(object):
         self.params = None
         self.render_tb = render_tb
         self.halt_on_exc = halt_on_exc
+        # Whether the script draws something new every frame.
+        self.animated = False
+        # The stdin env last passed to the script.
+        self.rendered_env = None
+        # The plain globals the script set on its last run, and whether
+        # a second run with the same input has set them alike.
+        self.state = None
+        self.settled = False
+        # Choose how render errors are handled once, rather than per frame.
+        self.exec = self.exec_halting if halt_on_exc else self.exec_trapping
 
     def reload(self, param_group):
         self.params = param_group
-        self.prog = compile(open(self.path, "r").read(), self.path, "exec")
-
+        self.prog = compile_script(self.path)
+        self.animated = any(
+            uses_name(self.prog, name) for name in ANIMATION_NAMES)
+        self.rendered_env = None
+        self.state = None
+        self.settled = False
+
+        env = param_group.getInitEnv()
         if self.halt_on_exc:
-            exec(self.prog, param_group.getInitEnv())
+            exec(self.prog, env)
         else:
             try:
-                exec(self.prog, param_group.getInitEnv())
+                exec(self.prog, env)
             except BaseException as e:
                 traceback.print_exc()
                 self.load_error = e
 
+        # Scripts can settle the question by setting `animated` at the
+        # top level.
+        if "animated" in env:
+            self.animated = bool(env["animated"])
+            self.settled = True
+
+    def exec_halting(self, env):
+        """Run the script in `env`, letting any error propagate."""
+        exec(self.prog, env)
+
+    def exec_trapping(self, env):
+        """Run the script in `env`, returning any error as text.
+
+        All errors are trapped, so that we can display them nicely.
+        When the traceback won't be rendered, the error is printed
+        every frame, so only its one-line summary is formatted.
+        """
+        try:
+            exec(self.prog, env)
+        except BaseException as e:
+            if self.render_tb:
+                return traceback.format_exc()
+            else:
+                return "".join(traceback.format_exception_only(type(e), e))
+
+    def needs_run(self):
+        """Whether running the script again could draw something new.
+
+        The reader replaces its env, rather than updating it, when a new
+        line arrives, so an unchanged env is the same object. Until the
+        script has settled, it is run again to check that the same input
+        gives the same result.
+        """
+        return (self.animated or not self.settled
+                or self.reader.env is not self.rendered_env)
+
+    def check_state(self, env, given, same_input):
+        """Mark the script animated if its globals changed for no reason.
+
+        `given` is the set of names in `env` before the script ran.
+        """
+        state = {name: value for (name, value) in env.items()
+                 if name not in given and type(value) in _PLAIN}
+        if same_input and self.state is not None:
+            if state != self.state:
+                self.animated = True
+            self.settled = True
+        self.state = state
+
     def run(self, cr, scale, window):
+        same_input = self.reader.env is self.rendered_env
+        self.rendered_env = self.reader.env
         with helpers.Save(cr):
-            error = None
-
             # scripts are dimensioned in mm.
             cr.scale(scale.x, scale.y)
             window = helpers.Rect.from_top_left(
@@ -63,35 +170,29 @@ class Script(object):
                 window.width / scale.x,
                 window.height / scale.y)
 
-            # Trap all errors for the script, so we can display them
-            # nicely.
-            if not self.halt_on_exc:
-                try:
-                    exec(self.prog,
-                        self.params.getRenderEnv(cr, scale, window, self.reader.env))
-                except BaseException as e:
-                    error = traceback.format_exc()
-            else:
-                exec(self.prog,
-                     self.params.getRenderEnv(cr, scale, window, self.reader.env))
+            env = self.params.getRenderEnv(cr, scale, window, self.reader.env)
+            given = set(env) if not self.settled else None
+            error = self.exec(env)
+            if given is not None:
+                self.check_state(env, given, same_input)
 
             self.transform = cr.get_matrix()
-            self.inverse_transform = cr.get_matrix()
+            self.inverse_transform = cairo.Matrix(*self.transform)
             self.inverse_transform.invert()
 
             # save the current point
             x, y = cr.get_current_point()
 
         with helpers.Save(cr):
-            # stroke any residual path for feedback
             cr.set_operator(cairo.OPERATOR_DIFFERENCE)
             cr.set_source_rgb(1.0, 1.0, 1.0)
+
+            # stroke any residual path for feedback
+            line_width = cr.get_line_width()
             cr.set_line_width(0.1)
             cr.stroke()
+            cr.set_line_width(line_width)
 
-        with helpers.Save(cr):
-            cr.set_source_rgb(1.0, 1.0, 1.0)
-            cr.set_operator(cairo.OPERATOR_DIFFERENCE)
             # draw the current point.
             x, y = self.transform.transform_point(x, y)
             cr.translate(x, y)
@@ -101,13 +202,15 @@ class Script(object):
             cr.line_to(0, 5)
             cr.stroke()
 
-        if error is not None and self.render_tb:
+        if error is None:
+            return
+
+        if self.render_tb:
             with helpers.Box(cr, window.inset(10), clip=False) as layout:
                 cr.set_source_rgba(1.0, 0.0, 0.0, 0.5)
-                cr.move_to(*layout.northwest())
-                for line in error.split('\n'):
+                (x, y) = layout.northwest()
+                for (i, line) in enumerate(error.split('\n')):
+                    cr.move_to(x, y + i * 10)
                     cr.show_text(line)
-                    cr.translate(0, 10)
-                    cr.move_to(*layout.northwest())
-        elif error is not None:
+        else:
             print(error, file=sys.stderr)
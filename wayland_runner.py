@@ -20,20 +20,17 @@
 # Heavily inspired by "surface.py" by Sean Vig, in the pywayland
 # examples directory. Adapted and expanded for this use-case.
 
-# TODOS:
-# - allow for keyboard interrupt to work, plus some way for graceful exit.
-# - damage region optimizations.
-
 
 """Stand-alone runner for pywayland."""
 
 
+import contextlib
 import math
 import mmap
-import json
 import os
+import queue
 import threading
-import time
+import traceback
 import sys
 
 import cairo
@@ -47,59 +44,187 @@ from pywayland.client import Display
 from pywayland.protocol.wayland import WlCompositor, WlShell, WlShm, WlOutput
 from pywayland.utils import AnonymousFile
 
+# Tee surfaces are an optional cairo feature. Without them, every frame
+# damages the whole window.
+HAVE_TEE = hasattr(cairo, "TeeSurface")
+
+# Set CAIRO_SANDBOX_DEBUG in the environment to log protocol chatter.
+DEBUG = bool(os.environ.get("CAIRO_SANDBOX_DEBUG"))
+
+
+def debug(*args):
+    if DEBUG:
+        print(*args)
+
+
+# orjson is considerably faster at decoding each frame's parameters,
+# but is optional.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+# The equivalent cairo format for each supported WlShm.format value.
+_CAIRO_FORMATS = {
+    WlShm.format.argb8888.value: cairo.Format.ARGB32,
+    WlShm.format.xrgb8888.value: cairo.Format.RGB24,
+    WlShm.format.rgb565.value: cairo.Format.RGB16_565,
+}
+
 
 def stride_for_format(width, format_):
-    """Return the stride length in bytes for given pixel width and format."""
-
-    if format_ == WlShm.format.argb8888.value:
-        return 4 * width
-    elif format_ == WlShm.format.xrgb8888.value:
-        return 4 * width
-    elif format_ == WlShm.format.rgb565.value:
-        return 2 * width
-    else:
-        raise ValueError("incompatible format: {}".format(repr(format_)))    
+    """Return the stride length in bytes for given pixel width and format.
+
+    This is the stride cairo requires, which may include padding.
+    """
+
+    return wayland_format_to_cairo_format(format_).stride_for_width(width)
 
 
 def wayland_format_to_cairo_format(format_):
     """Return the Cairo.Format value for the given WlShm.format."""
 
-    if format_ == WlShm.format.argb8888.value:
-        return cairo.Format.ARGB32
-    elif format_ == WlShm.format.xrgb8888.value:
-        return cairo.Format.RGB24
-    elif format_ == WlShm.format.rgb565.value:
-        return cairo.Format.RGB16_565
-    else:
+    try:
+        return _CAIRO_FORMATS[format_]
+    except KeyError:
         raise ValueError("incompatible format: {}".format(repr(format_)))
 
 
+@contextlib.contextmanager
+def shm_file(size):
+    """Yield the fd of a new shared memory file of `size` bytes.
+
+    Uses memfd_create where available, which needs no filesystem and
+    no name, and falls back to pywayland's AnonymousFile.
+    """
+    if not hasattr(os, "memfd_create"):
+        with AnonymousFile(size) as fd:
+            yield fd
+        return
+
+    fd = os.memfd_create("cairo-sandbox", os.MFD_CLOEXEC)
+    try:
+        os.ftruncate(fd, size)
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def union_extents(a, b):
+    """Return the smallest (x, y, width, height) box covering `a` and `b`."""
+    if not (a[2] and a[3]):
+        return b
+    if not (b[2] and b[3]):
+        return a
+    x0 = min(a[0], b[0])
+    y0 = min(a[1], b[1])
+    x1 = max(a[0] + a[2], b[0] + b[2])
+    y1 = max(a[1] + a[3], b[1] + b[3])
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+class Buffer(object):
+
+    """A shared memory buffer, and a cairo context which draws into it."""
+
+    def __init__(self, client, width, height, stride, format_):
+        self.shm_data, self.buffer = client.create_buffer(
+            width, height, stride)
+        self.buffer.dispatcher["release"] = self.release_handler
+        self.cairo_surface = cairo.ImageSurface.create_for_data(
+            self.shm_data,
+            format_,
+            width,
+            height,
+            stride)
+        self.cr = cairo.Context(self.cairo_surface)
+        # Set while the compositor may still read from the buffer.
+        self.busy = False
+        # The area drawn by the last frame painted into this buffer. A
+        # new buffer hasn't been cleared yet, so it all needs clearing.
+        self.extents = (0, 0, width, height)
+
+    def release_handler(self, buffer):
+        self.busy = False
+
+    def destroy(self):
+        self.cairo_surface.finish()
+        self.buffer.destroy()
+
+
 class Window(object):
 
     """Wrapper around pywayland window which configures painting."""
 
-    def __init__(self, client, width, height, on_paint=None):
+    # When the area which changed covers more than this fraction of the
+    # window, just damage the whole thing.
+    full_damage_ratio = 0.7
+
+    # Each buffer is the size of the window, so don't keep adding them
+    # while the compositor holds on to the ones we have.
+    max_buffers = 3
+
+    def __init__(self, client, width, height, on_paint=None,
+                 needs_paint=None):
+        self.client = client
         self.width = width
         self.height = height
+        # What the frame on screen drew, which the next one must erase.
+        self.extents = (0, 0, width, height)
         self.format = wayland_format_to_cairo_format(client.best_format())
+        self.stride = stride_for_format(width, client.best_format())
         self.on_paint = on_paint
+        # If given, called each frame to ask whether to paint at all.
+        self.needs_paint = needs_paint
+        self.invalid = True
 
         self.surface = client.compositor.create_surface()
         
+        # We draw at the output's full resolution; on a scaled output,
+        # say so, or the compositor will scale our buffer up again.
+        self.scale = client.output_scale
+        if self.scale != 1 and self.surface.version >= 3:
+            self.surface.set_buffer_scale(self.scale)
+        else:
+            self.scale = 1
+
+        # With xrgb8888, every frame is opaque; telling the compositor
+        # lets it skip whatever is underneath, or scan the buffer out
+        # directly. With argb8888, scripts may leave transparent pixels.
+        # Regions are in surface units.
+        if client.best_format() == WlShm.format.xrgb8888:
+            region = client.compositor.create_region()
+            region.add(0, 0, width // self.scale, height // self.scale)
+            self.surface.set_opaque_region(region)
+            region.destroy()
+
         self.shell_surface = client.shell.get_shell_surface(self.surface)
         self.shell_surface.dispatcher["ping"] = self.ping_handler
         self.set_fullscreen()
 
-        self.frame_callback = self.surface.frame()
-        self.frame_callback.dispatcher["done"] = self.redraw
-
-        self.shm_data, self.buffer = client.create_buffer(self.width, self.height)
-        self.cairo_surface = self.create_cairo_surface()
-        self.cr = cairo.Context(self.cairo_surface)
-        self.surface.attach(self.buffer, 0, 0)
+        self.frame_callback = None
+        self.arm_frame()
+
+        # Frames are painted into whichever buffer the compositor has
+        # released, so we never draw into one it is still reading.
+        self.buffers = [self.create_buffer() for i in range(2)]
+
+        # Scripts are run on a worker thread, so that a slow one doesn't
+        # hold up the event loop: buffers to paint go in `jobs`, and come
+        # back, with their damage, in `painted`. One job at a time.
+        self.jobs = queue.Queue()
+        self.painted = queue.Queue()
+        self.painting = False
+        self.worker = threading.Thread(target=self.render_loop, daemon=True)
+
+        # The surface isn't mapped, and so gets no frame callbacks,
+        # until it has a buffer; paint the first frame right here.
+        self.invalid = False
+        buffer = self.next_buffer()
+        self.present(buffer, self.render(buffer))
         self.surface.commit()
-
-        self.redraw(self.frame_callback, 0, destroy_callback=False)
+        self.worker.start()
 
     def set_fullscreen(self):
         self.shell_surface.set_fullscreen(0, 0, None)
@@ -109,48 +234,189 @@ class Window(object):
 
     def ping_handler(self, shell_surface, serial):
         shell_surface.pong(serial)
-        print("pinged/ponged")
-
-    def create_cairo_surface(self):
-        assert self.shm_data is not None
+        debug("pinged/ponged")
+
+    def invalidate(self):
+        """Make sure the next frame is painted."""
+        self.invalid = True
+
+    def create_buffer(self):
+        return Buffer(
+            self.client, self.width, self.height, self.stride, self.format)
+
+    def next_buffer(self):
+        """Return a buffer the compositor isn't using, or None."""
+        for buffer in self.buffers:
+            if not buffer.busy:
+                return buffer
+
+        # The compositor is holding on to all of them; rather than
+        # wait, add another, up to a point.
+        if len(self.buffers) >= self.max_buffers:
+            return None
+        buffer = self.create_buffer()
+        self.buffers.append(buffer)
+        return buffer
     
-        return cairo.ImageSurface.create_for_data(
-            self.shm_data,
-            self.format,
-            self.width,
-            self.height,
-            stride_for_format(self.width, self.format))
-    
-    def redraw(self, callback, time, destroy_callback=True):
-        if destroy_callback:
-            callback._destroy()
-    
-        self.paint(self.cr)
-        self.surface.damage(0, 0, self.width, self.height)
-    
-        callback = self.surface.frame()
-        callback.dispatcher["done"] = self.redraw
-    
-        self.surface.attach(self.buffer, 0, 0)
+    def arm_frame(self):
+        """Ask to be told when to draw the next frame, at next commit.
+
+        Frame callbacks fire once, so there is only ever one pending;
+        the previous one has fired by the time this is called, and is
+        destroyed here.
+        """
+        if self.frame_callback is not None:
+            self.frame_callback._destroy()
+        self.frame_callback = self.surface.frame()
+        self.frame_callback.dispatcher["done"] = self.redraw
+
+    def redraw(self, callback, time):
+        self.arm_frame()
+
+        # Show the frame the worker finished since the last callback.
+        try:
+            (buffer, damage) = self.painted.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            self.painting = False
+            self.present(buffer, damage)
+
+        # Unless nothing has changed, start on the next one.
+        if not self.painting and (self.invalid or self.needs_paint is None
+                                  or self.needs_paint()):
+            buffer = self.next_buffer()
+            if buffer is None:
+                # Every buffer is busy; try again on the next frame.
+                self.invalid = True
+            else:
+                self.invalid = False
+                self.painting = True
+                # Keep next_buffer() off it until the compositor
+                # releases it.
+                buffer.busy = True
+                self.jobs.put(buffer)
+
         self.surface.commit()
+
+    def present(self, buffer, damage):
+        """Attach a freshly painted buffer, ready for the next commit."""
+        self.surface.attach(buffer.buffer, 0, 0)
+        self.damage(*damage)
+        buffer.busy = True
+
+    def render_loop(self):
+        """Worker thread: paint each buffer posted to `jobs`, until None."""
+        while True:
+            buffer = self.jobs.get()
+            if buffer is None:
+                break
+            self.painted.put((buffer, self.render(buffer)))
+
+    def destroy(self):
+        """Stop painting, and release the window's protocol objects."""
+        self.jobs.put(None)
+        self.worker.join()
+        if self.frame_callback is not None:
+            self.frame_callback._destroy()
+        for buffer in self.buffers:
+            buffer.destroy()
+        self.shell_surface.destroy()
+        self.surface.destroy()
+
+    def render(self, buffer):
+        """Paint a frame into `buffer`, returning the area to damage."""
+        try:
+            damage = self.paint(buffer)
+        except BaseException:
+            traceback.print_exc()
+            damage = (0, 0, self.width, self.height)
+        # Make sure cairo has finished writing to the shared memory
+        # before the compositor reads it.
+        buffer.cairo_surface.flush()
+        return damage
+
+    def damage(self, x, y, width, height):
+        # damage_buffer (wl_surface version 4) takes buffer coordinates,
+        # which are what we measure in, whatever the buffer scale.
+        if self.surface.version >= 4:
+            self.surface.damage_buffer(x, y, width, height)
+        else:
+            # Round out to whole surface units.
+            s = self.scale
+            x0 = x // s
+            y0 = y // s
+            x1 = math.ceil((x + width) / s)
+            y1 = math.ceil((y + height) / s)
+            self.surface.damage(x0, y0, x1 - x0, y1 - y0)
+
+    def clamp_extents(self, extents):
+        """Round `extents` out to whole pixels, within the window."""
+        (x, y, width, height) = extents
+        x0 = max(math.floor(x), 0)
+        y0 = max(math.floor(y), 0)
+        x1 = min(math.ceil(x + width), self.width)
+        y1 = min(math.ceil(y + height), self.height)
+        return (x0, y0, max(x1 - x0, 0), max(y1 - y0, 0))
+
+    def limit_damage(self, extents):
+        """Return `extents`, or the whole window if that is nearly as big."""
+        if extents[2] * extents[3] > (
+                self.full_damage_ratio * self.width * self.height):
+            return (0, 0, self.width, self.height)
+        return extents
     
-    def paint(self, cr):
+    def paint(self, buffer):
+        """Paint a frame into `buffer`, returning the area to damage.
+
+        The frame is drawn straight into the buffer, over white, so that
+        operators like DIFFERENCE see the background. Where cairo has
+        tee surfaces, the drawing is also recorded, though never
+        replayed, to find the area it covers.
+        """
+        full = (0, 0, self.width, self.height)
+
+        # Outside of its extents, the buffer is already white.
+        cr = buffer.cr
+        cr.save()
+        cr.rectangle(*buffer.extents)
+        cr.clip()
+        cr.set_source_rgb(1.0, 1.0, 1.0)
+        cr.paint()
+        cr.restore()
+
+        if not HAVE_TEE:
+            buffer.extents = full
+            self.extents = full
+            self.on_paint(cairo.Context(buffer.cairo_surface))
+            return full
+
+        recording = cairo.RecordingSurface(
+            cairo.Content.COLOR_ALPHA, cairo.Rectangle(*full))
+        tee = cairo.TeeSurface(buffer.cairo_surface)
+        tee.add(recording)
         try:
-            self.cr.save()
-            self.cr.set_source_rgb(1.0, 1.0, 1.0)
-            self.cr.paint()
-            self.on_paint(cr)
+            self.on_paint(cairo.Context(tee))
         finally:
-            self.cr.restore()
+            tee.flush()
+            extents = self.clamp_extents(recording.ink_extents())
+            # The buffer now differs from the frame on screen wherever
+            # either of them drew.
+            damage = self.limit_damage(union_extents(self.extents, extents))
+            buffer.extents = extents
+            self.extents = extents
+        return damage
 
 
 class WaylandClient(object):
 
     """High level interface for wayland client."""
 
+    # Every frame is painted over an opaque white background, so there
+    # is no need for an alpha channel.
     preferred_formats = (
-        WlShm.format.argb8888,
         WlShm.format.xrgb8888,
+        WlShm.format.argb8888,
         WlShm.format.rgb565
     )
 
@@ -158,11 +424,15 @@ class WaylandClient(object):
         self.display = Display()
         self.connected = False
         self.formats = set()
+        self.format = None
+        # How many buffer pixels the output shows per surface unit.
+        self.output_scale = 1
 
         # initialize these to None
         self.compositor = None
         self.shell = None
         self.registry = None
+        self.windows = []
 
         self.connect()
 
@@ -176,7 +446,7 @@ class WaylandClient(object):
         self.height_mm = None
 
         self.display.connect()
-        print("connected to display")
+        debug("connected to display")
 
         registry = self.display.get_registry()
         registry.dispatcher["global"] = self.handler
@@ -194,11 +464,15 @@ class WaylandClient(object):
             self.display.dispatch(block=True)
             self.display.roundtrip()
 
+        # The supported formats are all known by now.
+        self.format = self.choose_format()
         self.connected = True
 
-    def create_window(self, width, height, on_paint):
+    def create_window(self, width, height, on_paint, needs_paint=None):
         self.ensure_connected()
-        return Window(self, width, height, on_paint)
+        window = Window(self, width, height, on_paint, needs_paint)
+        self.windows.append(window)
+        return window
         
     def handler(self, registry, id_, interface, version):
         if interface == "wl_compositor":
@@ -212,15 +486,28 @@ class WaylandClient(object):
             self.output = registry.bind(id_, WlOutput, version)
             self.output.dispatcher["geometry"] = self.geometry_handler
             self.output.dispatcher["mode"] = self.mode_handler
+            self.output.dispatcher["scale"] = self.scale_handler
         else:
-            print("Unhandled proxy:", interface)
+            debug("Unhandled proxy:", interface)
 
     def run(self):
+        """Dispatch events until the connection fails or ^C is pressed."""
         self.ensure_connected()
-        while self.display.dispatch(block=True) != -1:
+        try:
+            while self.display.dispatch(block=True) != -1:
+                pass
+        except KeyboardInterrupt:
             pass
-        time.sleep(1)
-        display.disconnect()
+        finally:
+            self.disconnect()
+
+    def disconnect(self):
+        for window in self.windows:
+            window.destroy()
+        self.windows = []
+        self.display.flush()
+        self.display.disconnect()
+        self.connected = False
 
     def shm_format_handler(self, unused, format_):
         self.formats.add(WlShm.format(format_))
@@ -228,7 +515,7 @@ class WaylandClient(object):
     def geometry_handler(self, unused, x, y, width, height, *wtf):
         self.width_mm = width
         self.height_mm = height
-        print(wtf)
+        debug(wtf)
 
     def mode_handler(self, unused, flags, width, height, refresh):
 	# XXX: magic number should be the "current flag", i.e. ignore other modes.
@@ -237,29 +524,41 @@ class WaylandClient(object):
             self.width_pixels = width
             self.height_pixels = height
             self.refresh_mhz = refresh
-        print("Output Mode: {}x{}@{} ({})".format(width, height, refresh, flags))
+        debug("Output Mode: {}x{}@{} ({})".format(
+            width, height, refresh, flags))
+
+    def scale_handler(self, unused, factor):
+        self.output_scale = factor
 
-    def create_buffer(self, width, height):
-        stride = stride_for_format(width, client.best_format())
+    def create_buffer(self, width, height, stride):
         size = stride * height
 
-        with AnonymousFile(size) as fd:
+        with shm_file(size) as fd:
             shm_data = mmap.mmap(
                 fd,
                 size,
                 prot=mmap.PROT_READ | mmap.PROT_WRITE,
                 flags=mmap.MAP_SHARED)
-            pool = client.shm.create_pool(fd, size)
+            # Cairo sweeps the whole buffer; huge pages, where the kernel
+            # offers them for shared memory, save a lot of TLB misses.
+            try:
+                shm_data.madvise(mmap.MADV_HUGEPAGE)
+            except (AttributeError, OSError):
+                pass
+            pool = self.shm.create_pool(fd, size)
             buff = pool.create_buffer(
                 0,
                 width,
                 height,
                 stride,
-                WlShm.format.argb8888.value)
+                self.format.value)
             pool.destroy()
             return shm_data, buff
 
     def best_format(self):
+        return self.format
+
+    def choose_format(self):
         for f in self.preferred_formats:
             if f in self.formats:
                 return f
@@ -272,17 +571,37 @@ class ReaderThread(threading.Thread):
     daemon = True
 
     def run(self):
+        # Only the latest env is ever painted, so read whatever is
+        # available in one go, and decode just its last complete line.
+        fd = sys.stdin.fileno()
+        pending = b""
         while True:
-            self.env = json.loads(sys.stdin.readline())
-
-def on_paint(cr):
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                # The last line may not end in a newline.
+                if pending.strip():
+                    self.env = json_loads(pending)
+                break
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in reversed(lines):
+                if line.strip():
+                    self.env = json_loads(line)
+                    break
+
+
+def get_scale(client):
+    """Return the output's pixels per mm."""
     if client.width_mm == 0 or client.height_mm == 0:
         print("Wayland reports bogus monitor dimensions!")
-        scale = Point(1, 1)
+        return Point(1, 1)
     else:
-        scale = Point(
+        return Point(
             client.width_pixels / client.width_mm,
             client.height_pixels / client.height_mm)
+
+
+def on_paint(cr):
     script.run(cr, scale, window)
 
 
@@ -294,6 +613,7 @@ if __name__ == "__main__":
     script.reload(params)
 
     client = WaylandClient()
+    scale = get_scale(client)
     window = Rect.from_top_left(
         Point(0, 0),
         client.width_pixels,
@@ -302,7 +622,8 @@ if __name__ == "__main__":
     w = client.create_window(
         client.width_pixels,
         client.height_pixels,
-        on_paint
+        on_paint,
+        script.needs_run
     )
     reader.start()
     client.run()